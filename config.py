@@ -17,6 +17,7 @@ class Config(object):
     NAME_TO_LABEL = None
     IMAGE_MAX_INSTANCES = 100
     PIXEL_MEANS = np.array([115.2, 118.8, 123.0])
+    DEBUG = False
 
     ###################################
     # Network config
@@ -28,6 +29,46 @@ class Config(object):
     BASE_ANCHOR_SIZE_LIST = [32, 64, 128, 256, 512]
     LEVEL = ['P2', 'P3', 'P4', 'P5', "P6"]
     BACKBONE_STRIDES = [4, 8, 16, 32, 64]
+    # The layout the backbone runs in. "channels_last" is what CPU inference
+    # needs. cuDNN is fastest in "channels_first", which only runs on a GPU
+    # (or on MKL CPU builds, see BACKBONE_MKL_CHANNELS_FIRST). Images come in
+    # NHWC, so with "channels_first" only the 3-channel input is transposed
+    # before the 7x7 stem. "channels_last" runs the whole backbone in NHWC
+    # without any transpose, which is faster for float16 on Tensor Core GPUs
+    # when cuDNN runs the convs natively in NHWC.
+    BACKBONE_DATA_FORMAT = "channels_last"
+    # Run the backbone in "channels_first" on MKL CPU builds whatever
+    # BACKBONE_DATA_FORMAT says: oneDNN keeps NCHW in its blocked layout across
+    # the MKL ops. Ignored on other builds; breaks if MKL is turned off at run
+    # time with TF_DISABLE_MKL=1.
+    BACKBONE_MKL_CHANNELS_FIRST = False
+    # Compile the backbone's bottleneck blocks with XLA
+    BACKBONE_JIT_COMPILE = False
+    # The dtype of backbone computation: "float32" or "float16". Weights are
+    # always kept in float32. Train float16 with a LOSS_SCALE above 1.
+    BACKBONE_DTYPE = "float32"
+    # Fold the backbone's frozen batch norms into the preceding convolutions
+    BACKBONE_FOLD_BATCH_NORM = True
+    # Add a bias to the last conv of every backbone block so Conv+Bias+Add can be
+    # fused. The pretrained checkpoint has no such biases, they start from zero.
+    BACKBONE_RESIDUAL_BIAS = False
+    # Recompute the activations of the deep backbone stages in the backward pass
+    # instead of storing them, which saves memory for a larger PER_GPU_IMAGE
+    BACKBONE_RECOMPUTE_GRAD = False
+    # Replace the backbone's stem max pool with a stride-2 3x3 conv (ResNet-D).
+    # The pretrained checkpoint has no such conv, it starts from scratch.
+    BACKBONE_CONV_STEM = False
+    # Simulate int8 inference in the backbone's blocks with fake-quant ops, to
+    # check the mAP of an int8 deployment. Only used for eval and predict
+    # graphs and needs the ranges that tools/calibrate.py writes to
+    # BACKBONE_QUANT_RANGES from BACKBONE_QUANT_CALIBRATION_STEPS images.
+    BACKBONE_QUANTIZE = False
+    BACKBONE_QUANT_RANGES = "./logs/backbone_quant_ranges.npz"
+    BACKBONE_QUANT_CALIBRATION_STEPS = 100
+    # Build the backbone's blocks as functions specialized per (channels,
+    # stride, dtype), shared by the blocks with the same signature. Only used
+    # for eval and predict graphs, the training graph always inlines them.
+    BACKBONE_SPECIALIZE_BLOCKS = False
 
 
     ###################################
@@ -35,6 +76,13 @@ class Config(object):
     ###################################
     GPU_GROUPS = ["/gpu:0", "/gpu:1"]
     NUM_GPUS = len(GPU_GROUPS)
+    # Train on GPU_GROUPS with tf.contrib.distribute.MirroredStrategy (all-reduce
+    # of the gradients) instead of tf.contrib.estimator.replicate_model_fn
+    MIRRORED_STRATEGY = False
+    # Let cuBLAS/cuDNN run float32 matmuls and convs on tensor cores, for the
+    # whole process. This is TF32 on Ampere and newer GPUs, but on Volta and
+    # Turing the products are rounded to float16, which loses precision.
+    FP32_TENSOR_OP_MATH = False
     COMPUTE_TIME = False
     CLIP_GRADIENT_NORM = 5.0
     EPOCH_BOUNDARY = [25]
@@ -44,6 +92,10 @@ class Config(object):
     MOMENTUM = 0.9
     LEARNING_RATE = 0.001
     PER_GPU_IMAGE = 2
+    # The loss is multiplied by LOSS_SCALE before computing gradients and the
+    # gradients are divided by it afterwards, so that small float16 gradients
+    # do not flush to zero. Keep 1 for float32.
+    LOSS_SCALE = 1
     
 
     ###################################
@@ -108,6 +160,8 @@ class TCTConfig(Config):
 
     # the summary and model will be saved in this location
     DEBUG =False
+    # trained on GPUs only, see tools/train.py
+    BACKBONE_DATA_FORMAT = "channels_first"
     MODLE_DIR = "./logs"
     BACKBONE_NET = "resnet_model"
     NET_NAME = "ResNet_FPN"
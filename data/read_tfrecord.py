@@ -97,12 +97,15 @@ def predict_parse_fn(example, config):
 
 def train_input_fn(config):
 
+    # MirroredStrategy feeds every GPU its own batch from the dataset,
+    # replicate_model_fn splits one batch across the GPUs
+    batch_size = config.PER_GPU_IMAGE if config.MIRRORED_STRATEGY else config.BATCH_SIZE
     dataset = tf.data.TFRecordDataset(os.path.join(config.DATA_DIR, config.DATASET_NAME, config.TRAIN_DATASET_NAME))
     dataset = dataset.apply(tf.contrib.data.shuffle_and_repeat(
                             buffer_size=config.BATCH_SIZE * 4,
                             count=config.EPOCH))
     dataset = dataset.apply(tf.contrib.data.map_and_batch(lambda x: train_parse_fn(x, config),
-                                                               config.BATCH_SIZE,
+                                                               batch_size,
                                                                num_parallel_batches=cpu_count()//2))
     dataset = dataset.prefetch(config.BATCH_SIZE * 4)
     return dataset
@@ -259,7 +259,7 @@ class FPNHead(object):
                                     name="fc1")(features)
                 net = tf.layers.batch_normalization(net,momentum=0.99,
                       epsilon=0.00001,training=is_training,fused=True)
-                net = layers.Activation("relu")(net)
+                net = tf.nn.relu(net)
                 net = layers.Conv2D(filters=1024,
                                     kernel_size=(1, 1),
                                     kernel_initializer="glorot_uniform",
@@ -267,7 +267,7 @@ class FPNHead(object):
                                     name="fc2")(net)
                 net = tf.layers.batch_normalization(net,momentum=0.99,
                       epsilon=0.00001,training=is_training,fused=True)
-                net = layers.Activation("relu")(net)
+                net = tf.nn.relu(net)
 
                 net = tf.squeeze(net, axis=[1, 2])
                 head_scores = layers.Dense(config.NUM_CLASS,
@@ -3,18 +3,38 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 
+import numpy as np
+import tensorflow as tf
+
 from . import resnet
 
 
 def get_network_byname(inputs,
                        config,
                        is_training,
-                       reuse):
+                       reuse,
+                       mode=tf.estimator.ModeKeys.TRAIN,
+                       quantizer=None):
 
     if config.BACKBONE_NET == 'resnet_model':
+        if quantizer is None and config.BACKBONE_QUANTIZE and mode != tf.estimator.ModeKeys.TRAIN:
+            # the calibrated ranges written by tools/calibrate.py
+            quantizer = resnet.Int8Quantizer(dict(np.load(config.BACKBONE_QUANT_RANGES)))
         features_map = resnet.resnet_v2(inputs=inputs,
                                         training=is_training,
-                                        reuse=reuse)
+                                        reuse=reuse,
+                                        data_format=config.BACKBONE_DATA_FORMAT,
+                                        mkl_channels_first=config.BACKBONE_MKL_CHANNELS_FIRST,
+                                        jit_compile=config.BACKBONE_JIT_COMPILE,
+                                        compute_dtype=config.BACKBONE_DTYPE,
+                                        fold_batch_norm=config.BACKBONE_FOLD_BATCH_NORM,
+                                        residual_bias=config.BACKBONE_RESIDUAL_BIAS,
+                                        debug_names=config.DEBUG,
+                                        recompute_grad=config.BACKBONE_RECOMPUTE_GRAD,
+                                        use_conv_stem=config.BACKBONE_CONV_STEM,
+                                        quantizer=quantizer,
+                                        specialize_blocks=(config.BACKBONE_SPECIALIZE_BLOCKS and
+                                                           mode != tf.estimator.ModeKeys.TRAIN))
         return None, features_map
 
 
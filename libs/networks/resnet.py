@@ -28,50 +28,233 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
+import functools
+
+import numpy as np
 import tensorflow as tf
+from tensorflow.python import pywrap_tensorflow
+from tensorflow.python.framework import function
+from tensorflow.python.training import moving_averages
+from tensorflow.python.util import nest
 
 _BATCH_NORM_DECAY = 0.997
 _BATCH_NORM_EPSILON = 1e-5
 DEFAULT_DTYPE = tf.float32
+# He initialization for the ReLU network: a truncated normal with variance
+# 2 / fan_in. One stateless instance is shared by every kernel.
+_KERNEL_INITIALIZER = tf.variance_scaling_initializer (
+    scale=2.0, mode='fan_in', distribution='normal')
+
+
+def _conv2d_accepts_explicit_padding():
+    """
+    Whether the `tf.nn.conv2d` wrapper accepts a list of paddings (TensorFlow
+    >= 1.14). The wrapper is tried once in a throwaway graph, since having
+    the `explicit_paddings` attr on the Conv2D op does not mean the Python
+    API passes a list through.
+    """
+    try:
+        with tf.Graph ().as_default ():
+            tf.nn.conv2d (tf.zeros ([1, 3, 3, 1]), tf.zeros ([3, 3, 1, 1]),
+                          strides=[1, 1, 1, 1],
+                          padding=[[0, 0], [1, 1], [1, 1], [0, 0]])
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+_EXPLICIT_PADDING = _conv2d_accepts_explicit_padding ()
+# The keys of the feature maps returned by resnet_v2, one per block layer.
+FEATURE_MAP_KEYS = ("C2", "C3", "C4", "C5")
 
 
 ################################################################################
 # Convenience functions for building the ResNet model.
 ################################################################################
-def batch_norm(inputs, training, data_format):
-    """Performs a batch normalization using a standard set of parameters."""
-    # We set fused=True for a significant performance boost. See
-    # https://www.tensorflow.org/performance/performance_guide#common_fused_ops
-    return tf.layers.batch_normalization (
-        inputs=inputs, axis=1 if data_format == 'channels_first' else 3,
-        momentum=_BATCH_NORM_DECAY, epsilon=_BATCH_NORM_EPSILON, center=True,
-        scale=True, training=training, fused=True)
+def _channel_axis(data_format):
+    return 1 if data_format == 'channels_first' else 3
+
+
+def _fused_data_format(data_format):
+    return 'NCHW' if data_format == 'channels_first' else 'NHWC'
 
 
-def fixed_padding(inputs, kernel_size, data_format):
+def _batch_norm_variables(channels):
     """
-      Pads the input along the spatial dimensions independently of input size.
-      Args:
-        inputs: A tensor of size [batch, channels, height_in, width_in] or
-          [batch, height_in, width_in, channels] depending on data_format.
-        kernel_size: The kernel to be used in the conv2d or max_pool2d operation.
-                     Should be a positive integer.
-        data_format: The input format ('channels_last' or 'channels_first').
-      Returns:
-        A tensor with the same format as the input with the data either intact
-        (if kernel_size == 1) or padded (if kernel_size > 1).
-      """
-    pad_total = kernel_size - 1
-    pad_beg = pad_total // 2
-    pad_end = pad_total - pad_beg
+    Creates the batch normalization parameters under the same names that
+    `tf.layers.batch_normalization` uses, so pretrained checkpoints still load.
+    """
+    with tf.variable_scope (None, default_name='batch_normalization'):
+        gamma = tf.get_variable (
+            'gamma', [channels], dtype=tf.float32,
+            initializer=tf.ones_initializer ())
+        beta = tf.get_variable (
+            'beta', [channels], dtype=tf.float32,
+            initializer=tf.zeros_initializer ())
+        moving_mean = tf.get_variable (
+            'moving_mean', [channels], dtype=tf.float32,
+            initializer=tf.zeros_initializer (), trainable=False)
+        moving_variance = tf.get_variable (
+            'moving_variance', [channels], dtype=tf.float32,
+            initializer=tf.ones_initializer (), trainable=False)
+    return gamma, beta, moving_mean, moving_variance
+
+
+def _apply_batch_norm(inputs, variables, training, data_format):
+    """Normalizes `inputs` with the variables from `_batch_norm_variables`."""
+    gamma, beta, moving_mean, moving_variance = variables
+
+    if not training:
+        outputs, _, _ = tf.nn.fused_batch_norm (
+            inputs, gamma, beta, mean=moving_mean, variance=moving_variance,
+            epsilon=_BATCH_NORM_EPSILON,
+            data_format=_fused_data_format (data_format), is_training=False)
+        return outputs
+
+    outputs, mean, variance = tf.nn.fused_batch_norm (
+        inputs, gamma, beta, epsilon=_BATCH_NORM_EPSILON,
+        data_format=_fused_data_format (data_format), is_training=True)
+    tf.add_to_collection (
+        tf.GraphKeys.UPDATE_OPS,
+        moving_averages.assign_moving_average (
+            moving_mean, mean, _BATCH_NORM_DECAY, zero_debias=False))
+    tf.add_to_collection (
+        tf.GraphKeys.UPDATE_OPS,
+        moving_averages.assign_moving_average (
+            moving_variance, variance, _BATCH_NORM_DECAY, zero_debias=False))
+    return outputs
+
+
+def _conv2d_kernel(in_channels, filters, kernel_size):
+    """
+    Creates a convolution kernel under the same name that `tf.layers.conv2d`
+    uses, so pretrained checkpoints still load. The kernel is kept in fp32 and
+    cast to the compute dtype where it is applied.
+    """
+    with tf.variable_scope (None, default_name='conv2d'):
+        return tf.get_variable (
+            'kernel', [kernel_size, kernel_size, in_channels, filters],
+            dtype=tf.float32, initializer=_KERNEL_INITIALIZER)
+
+
+def _conv2d_kernel_and_bias(in_channels, filters, kernel_size):
+    """
+    Like `_conv2d_kernel`, plus a zero-initialized bias under the name that
+    `tf.layers.conv2d(use_bias=True)` uses.
+    """
+    with tf.variable_scope (None, default_name='conv2d'):
+        kernel = tf.get_variable (
+            'kernel', [kernel_size, kernel_size, in_channels, filters],
+            dtype=tf.float32, initializer=_KERNEL_INITIALIZER)
+        bias = tf.get_variable (
+            'bias', [filters], dtype=tf.float32,
+            initializer=tf.zeros_initializer ())
+    return kernel, bias
+
+
+def _apply_residual(inputs, shortcut, bias, data_format):
+    """
+    Adds the shortcut to the output of a block's last convolution. With a
+    bias, Conv2D -> BiasAdd -> Add is emitted back to back so that the
+    grappler remapper can fuse it into a single kernel.
+    """
+    if bias is not None:
+        inputs = tf.nn.bias_add (inputs, tf.cast (bias, inputs.dtype),
+                                 data_format=_fused_data_format (data_format))
+    return inputs + shortcut
+
+
+class Int8Quantizer(object):
+    """
+    Simulates the int8 convolutions of a post-training quantized backbone.
+    Every quantization point is keyed by the name of the conv kernel variable
+    it belongs to, e.g. 'resnet_model/conv2d_5/kernel/input'.
+    Without `ranges` the quantizer is in calibration mode: it leaves the
+    tensors as they are and records the min and max of every point in
+    `observers`, for tools/calibrate.py to accumulate over a calibration set.
+    With `ranges`, a dict of the calibrated [min, max] of every point, the
+    points are fake-quantized to 8 bits with those ranges as constants:
+    activations per tensor, kernels symmetrically per output channel.
+    """
+
+    # The smallest width of a range, so that an all-zero tensor does not get a
+    # zero quantization scale.
+    MIN_RANGE = 1e-6
+
+    def __init__(self, ranges=None):
+        self.ranges = ranges
+        self.observers = {}
+
+    def __call__(self, inputs, key, per_channel=False):
+        if self.ranges is None:
+            axes = list (range (inputs.shape.ndims - 1)) if per_channel else None
+            self.observers[key] = (tf.reduce_min (inputs, axes),
+                                   tf.reduce_max (inputs, axes))
+            return inputs
+
+        min_value, max_value = (np.asarray (v, np.float32)
+                                for v in self.ranges[key])
+        # The range must contain zero and must not be empty.
+        min_value = np.minimum (min_value, 0.0)
+        max_value = np.maximum (max_value, min_value + self.MIN_RANGE)
+
+        dtype = inputs.dtype
+        inputs = tf.cast (inputs, tf.float32)
+        if per_channel:
+            bound = np.maximum (-min_value, max_value)
+            inputs = tf.fake_quant_with_min_max_vars_per_channel (
+                inputs, min=tf.constant (-bound), max=tf.constant (bound),
+                num_bits=8, narrow_range=True)
+        else:
+            inputs = tf.fake_quant_with_min_max_args (
+                inputs, min=float (min_value), max=float (max_value),
+                num_bits=8)
+        return tf.cast (inputs, dtype)
+
+
+def _apply_conv2d(inputs, kernel, strides, data_format, quantizer=None,
+                  quant_key=None):
+    """
+    Convolves `inputs` with a kernel from `_conv2d_kernel`. Strided
+    convolutions pad the input by an amount based only on the kernel size.
+    The padding is given to the conv op itself where TensorFlow supports
+    explicit paddings, which saves a separate pad kernel and a padded copy of
+    the feature map. Older versions fall back to a `tf.pad` before a 'VALID'
+    convolution. With a `quantizer`, both the input and the kernel go through
+    it first, keyed by `quant_key` or else by the kernel variable's name.
+    """
+    if quantizer is not None:
+        quant_key = quant_key or kernel.op.name
+        inputs = quantizer (inputs, quant_key + '/input')
+        kernel = quantizer (kernel, quant_key + '/kernel', per_channel=True)
+    kernel = tf.cast (kernel, inputs.dtype)
+    kernel_size = kernel.shape[0].value
 
     if data_format == 'channels_first':
-        padded_inputs = tf.pad (inputs, [[0, 0], [0, 0],
-                                         [pad_beg, pad_end], [pad_beg, pad_end]])
+        conv_strides = [1, 1, strides, strides]
     else:
-        padded_inputs = tf.pad (inputs, [[0, 0], [pad_beg, pad_end],
-                                         [pad_beg, pad_end], [0, 0]])
-    return padded_inputs
+        conv_strides = [1, strides, strides, 1]
+
+    if strides == 1:
+        padding = 'SAME'
+    elif kernel_size == 1:
+        padding = 'VALID'
+    else:
+        pad_total = kernel_size - 1
+        pad_beg = pad_total // 2
+        pad_end = pad_total - pad_beg
+        if data_format == 'channels_first':
+            padding = [[0, 0], [0, 0], [pad_beg, pad_end], [pad_beg, pad_end]]
+        else:
+            padding = [[0, 0], [pad_beg, pad_end], [pad_beg, pad_end], [0, 0]]
+        if not _EXPLICIT_PADDING:
+            inputs = tf.pad (inputs, padding)
+            padding = 'VALID'
+
+    return tf.nn.conv2d (
+        inputs, kernel, strides=conv_strides, padding=padding,
+        data_format=_fused_data_format (data_format))
 
 
 def conv2d_fixed_padding(inputs, filters, kernel_size, strides, data_format):
@@ -80,18 +263,61 @@ def conv2d_fixed_padding(inputs, filters, kernel_size, strides, data_format):
   The padding is consistent and is based only on `kernel_size`, not on the
   dimensions of `inputs` (as opposed to using `tf.layers.conv2d` alone).
   """
-    if strides > 1:
-        inputs = fixed_padding (inputs, kernel_size, data_format)
+    kernel = _conv2d_kernel (inputs.shape[_channel_axis (data_format)].value,
+                             filters, kernel_size)
+    return _apply_conv2d (inputs, kernel, strides, data_format)
+
+
+def _apply_conv2d_batch_norm(inputs, kernel, bn_variables, strides, training,
+                             data_format, fold_batch_norm, quantizer=None):
+    """
+    A convolution followed by a batch normalization. When `fold_batch_norm` is
+    True and the model is not training, the normalization is folded into the
+    convolution:
+        w' = w * gamma / sqrt(var + eps)
+        b' = beta - mean * gamma / sqrt(var + eps)
+    Both paths use the same variables, so they restore from the same
+    checkpoint. The folded weights are computed from the variables in fp32,
+    which is cheap next to a feature-map sized BN. With a `quantizer`, the
+    folded kernel is quantized and the bias stays in float, as in an int8
+    conv.
+    """
+    if not fold_batch_norm or training:
+        inputs = _apply_conv2d (inputs, kernel, strides, data_format, quantizer)
+        return _apply_batch_norm (inputs, bn_variables, training, data_format)
 
-    return tf.layers.conv2d (
-        inputs=inputs, filters=filters, kernel_size=kernel_size, strides=strides,
-        padding=('SAME' if strides == 1 else 'VALID'), use_bias=False,
-        kernel_initializer=tf.variance_scaling_initializer (),
-        data_format=data_format)
+    gamma, beta, moving_mean, moving_variance = bn_variables
+    scale = gamma * tf.rsqrt (moving_variance + _BATCH_NORM_EPSILON)
+    bias = tf.cast (beta - moving_mean * scale, inputs.dtype)
 
+    outputs = _apply_conv2d (inputs, kernel * scale, strides, data_format,
+                             quantizer, kernel.op.name)
+    return tf.nn.bias_add (outputs, bias,
+                           data_format=_fused_data_format (data_format))
+
+
+def _building_block_v2_variables(in_channels, filters, projection_filters,
+                                 residual_bias=False):
+    """
+    Creates the variables of a `_building_block_v2`, in the order the block
+    consumes them. `residual_bias` adds a bias to the last convolution.
+    """
+    variables = {'preact_bn': _batch_norm_variables (in_channels)}
+    if projection_filters:
+        variables['projection_shortcut'] = _conv2d_kernel (
+            in_channels, projection_filters, 1)
+    variables['conv1'] = _conv2d_kernel (in_channels, filters, 3)
+    variables['bn1'] = _batch_norm_variables (filters)
+    if residual_bias:
+        variables['conv2'], variables['conv2_bias'] = _conv2d_kernel_and_bias (
+            filters, filters, 3)
+    else:
+        variables['conv2'] = _conv2d_kernel (filters, filters, 3)
+    return variables
 
-def _building_block_v2(inputs, filters, training, projection_shortcut, strides,
-                       data_format):
+
+def _building_block_v2(inputs, variables, training, strides, data_format,
+                       fold_batch_norm=False, quantizer=None):
     """A single block for ResNet v2, without a bottleneck.
       Batch normalization then ReLu then convolution as described by:
         Identity Mappings in Deep Residual Networks
@@ -100,14 +326,17 @@ def _building_block_v2(inputs, filters, training, projection_shortcut, strides,
       Args:
         inputs: A tensor of size [batch, channels, height_in, width_in] or
           [batch, height_in, width_in, channels] depending on data_format.
-        filters: The number of filters for the convolutions.
+        variables: The block's variables from `_building_block_v2_variables`.
+          When they include a 'projection_shortcut' kernel, the shortcut is a
+          1x1 convolution with the block's stride.
         training: A Boolean for whether the model is in training or inference
           mode. Needed for batch normalization.
-        projection_shortcut: The function to use for projection shortcuts
-          (typically a 1x1 convolution when downsampling the input).
         strides: The block's stride. If greater than 1, this block will ultimately
           downsample the input.
         data_format: The input format ('channels_last' or 'channels_first').
+        fold_batch_norm: Whether to fold the batch norms that directly follow
+          a convolution into it when not training.
+        quantizer: An `Int8Quantizer` to simulate int8 convolutions with.
       Returns:
         The output tensor of the block; shape should match inputs.
           input
@@ -134,29 +363,54 @@ def _building_block_v2(inputs, filters, training, projection_shortcut, strides,
         +
     """
     shortcut = inputs
-    inputs = batch_norm (inputs, training, data_format)
+    inputs = _apply_batch_norm (inputs, variables['preact_bn'], training,
+                                data_format)
     inputs = tf.nn.relu (inputs)
 
     # The projection shortcut should come after the first batch norm and ReLU
     # since it performs a 1x1 convolution.
-    if projection_shortcut is not None:
-        shortcut = projection_shortcut (inputs)
-
-    inputs = conv2d_fixed_padding (
-        inputs=inputs, filters=filters, kernel_size=3, strides=strides,
-        data_format=data_format)
+    if 'projection_shortcut' in variables:
+        shortcut = _apply_conv2d (inputs, variables['projection_shortcut'],
+                                  strides, data_format, quantizer)
 
-    inputs = batch_norm (inputs, training, data_format)
+    inputs = _apply_conv2d_batch_norm (
+        inputs, variables['conv1'], variables['bn1'], strides, training,
+        data_format, fold_batch_norm, quantizer)
     inputs = tf.nn.relu (inputs)
-    inputs = conv2d_fixed_padding (
-        inputs=inputs, filters=filters, kernel_size=3, strides=1,
-        data_format=data_format)
+    inputs = _apply_conv2d (inputs, variables['conv2'], 1, data_format,
+                            quantizer)
+    if quantizer is not None:
+        # requantize the conv output before the residual add
+        inputs = quantizer (inputs, variables['conv2'].op.name + '/output')
 
-    return inputs + shortcut
+    return _apply_residual (inputs, shortcut, variables.get ('conv2_bias'),
+                            data_format)
 
 
-def _bottleneck_block_v2(inputs, filters, training, projection_shortcut,
-                         strides, data_format):
+def _bottleneck_block_v2_variables(in_channels, filters, projection_filters,
+                                   residual_bias=False):
+    """
+    Creates the variables of a `_bottleneck_block_v2`, in the order the block
+    consumes them. `residual_bias` adds a bias to the last convolution.
+    """
+    variables = {'preact_bn': _batch_norm_variables (in_channels)}
+    if projection_filters:
+        variables['projection_shortcut'] = _conv2d_kernel (
+            in_channels, projection_filters, 1)
+    variables['conv1'] = _conv2d_kernel (in_channels, filters, 1)
+    variables['bn1'] = _batch_norm_variables (filters)
+    variables['conv2'] = _conv2d_kernel (filters, filters, 3)
+    variables['bn2'] = _batch_norm_variables (filters)
+    if residual_bias:
+        variables['conv3'], variables['conv3_bias'] = _conv2d_kernel_and_bias (
+            filters, 4 * filters, 1)
+    else:
+        variables['conv3'] = _conv2d_kernel (filters, 4 * filters, 1)
+    return variables
+
+
+def _bottleneck_block_v2(inputs, variables, training, strides, data_format,
+                         fold_batch_norm=False, quantizer=None):
     """A single block for ResNet v2, without a bottleneck.
           Similar to _building_block_v2(), except using the "bottleneck" blocks
           described in:
@@ -172,47 +426,163 @@ def _bottleneck_block_v2(inputs, filters, training, projection_shortcut,
           Args:
             inputs: A tensor of size [batch, channels, height_in, width_in] or
               [batch, height_in, width_in, channels] depending on data_format.
-            filters: The number of filters for the convolutions.
+            variables: The block's variables from
+              `_bottleneck_block_v2_variables`. When they include a
+              'projection_shortcut' kernel, the shortcut is a 1x1 convolution
+              with the block's stride.
             training: A Boolean for whether the model is in training or inference
               mode. Needed for batch normalization.
-            projection_shortcut: The function to use for projection shortcuts
-              (typically a 1x1 convolution when downsampling the input).
             strides: The block's stride. If greater than 1, this block will ultimately
               downsample the input.
             data_format: The input format ('channels_last' or 'channels_first').
+            fold_batch_norm: Whether to fold the batch norms that directly follow
+              a convolution into it when not training.
+            quantizer: An `Int8Quantizer` to simulate int8 convolutions with.
           Returns:
             The output tensor of the block; shape should match inputs.
           """
     shortcut = inputs
-    inputs = batch_norm (inputs, training, data_format)
+    inputs = _apply_batch_norm (inputs, variables['preact_bn'], training,
+                                data_format)
     inputs = tf.nn.relu (inputs)
 
     # The projection shortcut should come after the first batch norm and ReLU
     # since it performs a 1x1 convolution.
-    if projection_shortcut is not None:
-        shortcut = projection_shortcut (inputs)
-
-    inputs = conv2d_fixed_padding (
-        inputs=inputs, filters=filters, kernel_size=1, strides=1,
-        data_format=data_format)
+    if 'projection_shortcut' in variables:
+        shortcut = _apply_conv2d (inputs, variables['projection_shortcut'],
+                                  strides, data_format, quantizer)
 
-    inputs = batch_norm (inputs, training, data_format)
+    inputs = _apply_conv2d_batch_norm (
+        inputs, variables['conv1'], variables['bn1'], 1, training,
+        data_format, fold_batch_norm, quantizer)
     inputs = tf.nn.relu (inputs)
-    inputs = conv2d_fixed_padding (
-        inputs=inputs, filters=filters, kernel_size=3, strides=strides,
-        data_format=data_format)
 
-    inputs = batch_norm (inputs, training, data_format)
+    inputs = _apply_conv2d_batch_norm (
+        inputs, variables['conv2'], variables['bn2'], strides, training,
+        data_format, fold_batch_norm, quantizer)
     inputs = tf.nn.relu (inputs)
-    inputs = conv2d_fixed_padding (
-        inputs=inputs, filters=4 * filters, kernel_size=1, strides=1,
-        data_format=data_format)
+    inputs = _apply_conv2d (inputs, variables['conv3'], 1, data_format,
+                            quantizer)
+    if quantizer is not None:
+        # requantize the conv output before the residual add
+        inputs = quantizer (inputs, variables['conv3'].op.name + '/output')
+
+    return _apply_residual (inputs, shortcut, variables.get ('conv3_bias'),
+                            data_format)
 
-    return inputs + shortcut
+
+def block_layer_variables(in_channels, filters, bottleneck, blocks,
+                          residual_bias=False):
+    """Creates the variables of every block in one layer of blocks.
+          Creating them up front, in the order the blocks consume them, keeps
+          the variable names identical to building the blocks one by one.
+          Args:
+            in_channels: The number of channels of the block layer's input.
+            filters: The number of filters for the first convolution of the layer.
+            bottleneck: Is the block created a bottleneck block.
+            blocks: The number of blocks contained in the layer.
+            residual_bias: Whether the last convolution of every block has a
+              bias, which lets Conv2D+BiasAdd+Add fuse on the residual sum.
+          Returns:
+            A list with the variable dict of every block.
+          """
+    # Bottleneck blocks end with 4x the number of filters as they start with
+    filters_out = filters * 4 if bottleneck else filters
+    if bottleneck:
+        block_variables_fn = _bottleneck_block_v2_variables
+    else:
+        block_variables_fn = _building_block_v2_variables
+
+    # Only the first block per block_layer uses a projection shortcut
+    variables = [block_variables_fn (in_channels, filters, filters_out,
+                                     residual_bias)]
+    for _ in range (1, blocks):
+        variables.append (block_variables_fn (filters_out, filters, None,
+                                              residual_bias))
+    return variables
+
+
+def _recompute_blocks(inputs, block_fn, variables, training, data_format,
+                      fold_batch_norm):
+    """
+    Applies a chain of stride-1 blocks whose activations are not kept for the
+    backward pass but recomputed from `inputs` when the gradients are built.
+    `tf.contrib.layers.recompute_grad` only propagates gradients to its tensor
+    arguments and to variables created inside the function, so the block
+    variables are passed in as tensors.
+    """
+    flat_variables = nest.flatten (variables)
+
+    def blocks_fn(inputs, *flat_values):
+        block_variables = nest.pack_sequence_as (variables, list (flat_values))
+        for block_variable in block_variables:
+            inputs = block_fn (inputs, block_variable, training, 1, data_format,
+                               fold_batch_norm)
+        return inputs
+
+    return tf.contrib.layers.recompute_grad (blocks_fn) (
+        inputs, *[tf.convert_to_tensor (v) for v in flat_variables])
+
+
+def _specialize_block(block_fn, filters_out):
+    """
+    Wraps `block_fn` so that every block is called through a `Defun` that is
+    specialized for its input dtype and channels, stride and variable shapes.
+    Blocks with the same signature, i.e. all but the first of a block layer,
+    share one function. The variables are passed in as tensors so nothing is
+    captured from the outer graph, and the static shapes, which a function
+    call loses, are restored on both sides of the call. The function contains
+    no update ops, so it only applies with frozen batch norms, and it has no
+    Python gradient, so it is only meant for graphs that are not
+    differentiated. Quantized blocks are not specialized, since a function
+    only sees the kernels as tensors, not by the variable names their
+    quantization ranges are keyed by.
+    """
+    functions = {}
+
+    def specialized_block_fn(inputs, variables, training, strides, data_format,
+                             fold_batch_norm=False):
+        channel_axis = _channel_axis (data_format)
+        flat_variables = [tf.convert_to_tensor (v)
+                          for v in nest.flatten (variables)]
+        variable_shapes = [v.shape for v in flat_variables]
+        key = (training, data_format, fold_batch_norm, inputs.dtype,
+               inputs.shape[channel_axis].value, strides,
+               tuple (tuple (shape.as_list ()) for shape in variable_shapes))
+
+        if key not in functions:
+            input_shape = [None] * 4
+            input_shape[channel_axis] = inputs.shape[channel_axis].value
+
+            @function.Defun (inputs.dtype, *[v.dtype for v in flat_variables])
+            def block(block_inputs, *flat_values):
+                block_inputs.set_shape (input_shape)
+                for value, shape in zip (flat_values, variable_shapes):
+                    value.set_shape (shape)
+                block_variables = nest.pack_sequence_as (variables,
+                                                         list (flat_values))
+                return block_fn (block_inputs, block_variables, training,
+                                 strides, data_format, fold_batch_norm)
+
+            functions[key] = block
+
+        outputs = functions[key] (inputs, *flat_variables)
+        output_shape = inputs.shape.as_list ()
+        for axis, dim in enumerate (output_shape):
+            if axis == channel_axis:
+                output_shape[axis] = filters_out
+            elif axis > 0 and dim is not None:
+                output_shape[axis] = (dim + strides - 1) // strides
+        outputs.set_shape (output_shape)
+        return outputs
+
+    return specialized_block_fn
 
 
 def block_layer(inputs, filters, bottleneck, block_fn, blocks, strides,
-                training, name, data_format):
+                training, name, data_format, fold_batch_norm=False,
+                variables=None, debug_names=False, recompute_grad=False,
+                quantizer=None, specialize=False):
     """Creates one layer of blocks for the ResNet model.
           Args:
             inputs: A tensor of size [batch, channels, height_in, width_in] or
@@ -228,61 +598,228 @@ def block_layer(inputs, filters, bottleneck, block_fn, blocks, strides,
               model. Needed for batch norm.
             name: A string name for the tensor output of the block layer.
             data_format: The input format ('channels_last' or 'channels_first').
+            fold_batch_norm: Whether to fold the batch norms that directly follow
+              a convolution into it when not training.
+            variables: The block variables from `block_layer_variables`. They are
+              created here when None.
+            debug_names: Whether to end the layer with an identity op named
+              `<name>/output`. The blocks are built under the `name` scope
+              either way.
+            recompute_grad: Whether to recompute the activations of every block
+              after the first one in the backward pass instead of keeping
+              them, for layers of at least 4 blocks. Only applies when the
+              batch norms are frozen (`training` is False), since recomputing
+              them would repeat their moving average updates.
+            quantizer: An `Int8Quantizer` to simulate int8 convolutions with
+              in every block. The blocks of a quantized layer are neither
+              recomputed nor specialized.
+            specialize: Whether to build the blocks as functions specialized
+              for their signature, see `_specialize_block`. Only applies
+              when `training` is False, and only for graphs that are not
+              differentiated.
           Returns:
             The output tensor of the block layer.
           """
+    if variables is None:
+        variables = block_layer_variables (
+            inputs.shape[_channel_axis (data_format)].value, filters,
+            bottleneck, blocks)
+
+    if quantizer is not None:
+        # The quantization ranges are keyed by the kernel variables, which the
+        # recomputed and specialized blocks only see as tensors.
+        block_fn = functools.partial (block_fn, quantizer=quantizer)
+        recompute_grad = specialize = False
+    elif specialize and not training:
+        block_fn = _specialize_block (block_fn,
+                                      filters * 4 if bottleneck else filters)
+
+    with tf.name_scope (name):
+        # Only the first block per block_layer has a projection shortcut and strides
+        inputs = block_fn (inputs, variables[0], training, strides,
+                           data_format, fold_batch_norm)
+
+        if recompute_grad and not training and len (variables) >= 4:
+            inputs = _recompute_blocks (inputs, block_fn, variables[1:],
+                                        training, data_format, fold_batch_norm)
+        else:
+            for block_variables in variables[1:]:
+                inputs = block_fn (inputs, block_variables, training, 1,
+                                   data_format, fold_batch_norm)
+
+        if debug_names:
+            inputs = tf.identity (inputs, 'output')
+    return inputs
+
+
+@contextlib.contextmanager
+def _xla_jit_scope(enabled):
+    """Clusters the ops built inside the scope for XLA when `enabled` is True."""
+    if enabled:
+        with tf.contrib.compiler.jit.experimental_jit_scope ():
+            yield
+    else:
+        yield
 
-    # Bottleneck blocks end with 4x the number of filters as they start with
-    filters_out = filters * 4 if bottleneck else filters
-
-    def projection_shortcut(inputs):
-        return conv2d_fixed_padding (
-            inputs=inputs, filters=filters_out, kernel_size=1, strides=strides,
-            data_format=data_format)
-
-    # Only the first block per block_layer uses projection_shortcut and strides
-    inputs = block_fn (inputs, filters, training, projection_shortcut, strides,
-                       data_format)
-
-    for _ in range (1, blocks):
-        inputs = block_fn (inputs, filters, training, None, 1, data_format)
 
-    return tf.identity (inputs, name)
+def _is_built_with_mkl():
+    is_mkl_enabled = getattr (pywrap_tensorflow, 'IsMklEnabled', None)
+    return bool (is_mkl_enabled and is_mkl_enabled ())
 
 
-def resnet_v2(inputs, training, reuse=tf.AUTO_REUSE, data_format="channels_last"):
+def resnet_v2(inputs, training, reuse=tf.AUTO_REUSE, data_format='channels_last',
+              jit_compile=False, compute_dtype=DEFAULT_DTYPE,
+              fold_batch_norm=False, residual_bias=False, debug_names=False,
+              recompute_grad=False, use_conv_stem=False, quantizer=None,
+              specialize_blocks=False, mkl_channels_first=False):
     """Add operations to classify a batch of input images.
     Args:
-      inputs: A Tensor representing a batch of input images.
-      training: A boolean. Set to True to add operations required only when
-        training the classifier.
+      inputs: A Tensor representing a batch of input images in NHWC layout.
+      training: A Python boolean. Set to True to add operations required only
+        when training the classifier.
+      data_format: The format the backbone runs in ('channels_last' or
+        'channels_first'). The stock CPU kernels need 'channels_last'. cuDNN
+        runs convolutions and fused batch norm fastest in 'channels_first',
+        so GPU-only graphs should ask for it. In 'channels_first' only the
+        3-channel input is transposed, right before the 7x7 stem; in
+        'channels_last' the backbone needs no transpose at all, which suits
+        float16 Tensor Core convolutions that run natively in NHWC.
+      jit_compile: Whether to compile the bottleneck block layers with XLA so
+        BN, ReLU and conv are fused into fewer kernels. The stem stays outside
+        the XLA cluster.
+      compute_dtype: The dtype the bottleneck blocks compute in, float32 or
+        float16. With float16 the weights are still stored in fp32 and cast
+        where they are used, and the stem as well as the returned feature
+        maps stay in fp32. bfloat16 is rejected: TensorFlow 1.x has no
+        bfloat16 GPU kernels for Conv2D and FusedBatchNorm.
+      fold_batch_norm: Whether to fold each batch norm that directly follows a
+        convolution into that convolution's kernel and a bias. Only applies
+        when `training` is False; the pre-activation batch norm at the start of
+        every block follows the residual add and is kept as is.
+      residual_bias: Whether the last convolution of every block has a bias,
+        so that Conv2D+BiasAdd+Add can be fused on the residual sum. The
+        pretrained resnet_model checkpoint has no such biases.
+      debug_names: Whether to add named identity ops after the stem and every
+        block layer. They are no-op copies that can split fusion chains, so
+        they are left out by default; the ops stay grouped under the
+        `initial_conv`, `initial_max_pool` and `block_layerN` name scopes.
+      recompute_grad: Whether to recompute the activations of the deep block
+        layers (4 and 6 blocks) in the backward pass rather than keeping them
+        in memory. Only applies when `training` is False, i.e. with the frozen
+        batch norms this detector trains with.
+      use_conv_stem: Whether to downsample after the initial conv with a
+        stride-2 3x3 conv + batch norm + ReLU instead of a 3x3 max pool. Its
+        variables live under `resnet_model/conv_stem`, which the pretrained
+        checkpoint does not have, so keep this False to use the pretrained
+        stem as is.
+      quantizer: An `Int8Quantizer` to simulate int8 inference in the
+        bottleneck blocks with: every conv input and (batch norm folded)
+        kernel is fake-quantized to 8 bits, and so is the last conv of every
+        block before the residual add. The calibrated ranges are constants,
+        so the same checkpoint restores. The 7x7 stem and the returned feature
+        maps stay in float. Implies `fold_batch_norm` when not training.
+      specialize_blocks: Whether to build every bottleneck block as a `Defun`
+        specialized for its input channels, stride and dtype, which blocks of
+        the same signature share. Only applies when `training` is False. The
+        functions have no Python gradient, so only set this for eval and
+        predict graphs, never for a graph that is trained.
+      mkl_channels_first: Whether to run in 'channels_first' instead of
+        `data_format` when TensorFlow is built with MKL. MKL builds reorder
+        NCHW into oneDNN's blocked NCHWc layout once at the first conv and
+        keep it through the following MKL ops. It is an opt-in because a
+        graph that falls back to the stock CPU kernels, e.g. with
+        TF_DISABLE_MKL=1, fails on NCHW batch norm and pooling.
     Returns:
-      A logits Tensor with shape [<batch_size>, self.num_classes].
+      A dict {C2:,----,C5:} of feature maps in NHWC layout.
     """
+    if mkl_channels_first and _is_built_with_mkl ():
+        data_format = 'channels_first'
+
+    compute_dtype = tf.as_dtype (compute_dtype)
+    if compute_dtype not in (tf.float32, tf.float16):
+        raise ValueError ('compute_dtype must be float32 or float16, got %s'
+                          % compute_dtype.name)
+    # int8 kernels quantize the conv after the batch norm is folded into it
+    fold_batch_norm = fold_batch_norm or quantizer is not None
+
     with tf.variable_scope ('resnet_model', reuse=reuse):
-        inputs = conv2d_fixed_padding (
-            inputs=inputs, filters=64, kernel_size=7,
-            strides=2, data_format=data_format)
-        inputs = tf.identity (inputs, 'initial_conv')
+        if data_format == 'channels_first':
+            # Only the 3-channel image is transposed on the way in.
+            inputs = tf.transpose (inputs, [0, 3, 1, 2])
+
+        with tf.name_scope ('initial_conv'):
+            inputs = conv2d_fixed_padding (
+                inputs=inputs, filters=64, kernel_size=7,
+                strides=2, data_format=data_format)
+            if debug_names:
+                inputs = tf.identity (inputs, 'output')
 
         # We do not include batch normalization or activation functions in V2
         # for the initial conv1 because the first ResNet unit will perform these
         # for both the shortcut and non-shortcut paths as part of the first
         # block's projection. Cf. Appendix of [2].
-        inputs = tf.layers.max_pooling2d (
-            inputs=inputs, pool_size=3,
-            strides=2, padding='SAME',
-            data_format=data_format)
-        inputs = tf.identity (inputs, 'initial_max_pool')
-        block_strides = [1, 2, 2, 2]
-        image_feature_map = {}
-        for i, num_blocks in enumerate ([3, 4, 6, 3]):
-            num_filters = 64 * (2 ** i)
-            inputs = block_layer (
-                inputs=inputs, filters=num_filters, bottleneck=True,
-                block_fn=_bottleneck_block_v2, blocks=num_blocks,
-                strides=block_strides[i], training=training,
-                name='block_layer{}'.format (i + 1), data_format=data_format)
-            image_feature_map["C%d" % (i + 2)] = inputs
-
-        return image_feature_map
\ No newline at end of file
+        if use_conv_stem:
+            # A compute-bound strided conv in place of the memory-bound max
+            # pool, whose gradient is a scatter. Its own variable scope keeps
+            # the names of all other variables unchanged.
+            with tf.variable_scope ('conv_stem'):
+                inputs = _apply_conv2d_batch_norm (
+                    inputs, _conv2d_kernel (64, 64, 3),
+                    _batch_norm_variables (64), 2, training, data_format,
+                    fold_batch_norm)
+                inputs = tf.nn.relu (inputs)
+                if debug_names:
+                    inputs = tf.identity (inputs, 'output')
+        else:
+            if data_format == 'channels_first':
+                pool_size, pool_strides = [1, 1, 3, 3], [1, 1, 2, 2]
+            else:
+                pool_size, pool_strides = [1, 3, 3, 1], [1, 2, 2, 1]
+            with tf.name_scope ('initial_max_pool'):
+                inputs = tf.nn.max_pool (
+                    inputs, ksize=pool_size, strides=pool_strides, padding='SAME',
+                    data_format=_fused_data_format (data_format))
+                if debug_names:
+                    inputs = tf.identity (inputs, 'output')
+        inputs = tf.cast (inputs, compute_dtype)
+
+        # Create the variables of all blocks once, before any block is built.
+        # The block layers of ResNet-50: (in_channels, filters, blocks).
+        layer1_variables = block_layer_variables (64, 64, True, 3,
+                                                  residual_bias)
+        layer2_variables = block_layer_variables (256, 128, True, 4,
+                                                  residual_bias)
+        layer3_variables = block_layer_variables (512, 256, True, 6,
+                                                  residual_bias)
+        layer4_variables = block_layer_variables (1024, 512, True, 3,
+                                                  residual_bias)
+
+        bottleneck_layer = functools.partial (
+            block_layer, bottleneck=True, block_fn=_bottleneck_block_v2,
+            training=training, data_format=data_format,
+            fold_batch_norm=fold_batch_norm, debug_names=debug_names,
+            recompute_grad=recompute_grad, quantizer=quantizer,
+            specialize=specialize_blocks)
+        with _xla_jit_scope (jit_compile):
+            c2 = bottleneck_layer (inputs, filters=64, blocks=3, strides=1,
+                                   name='block_layer1',
+                                   variables=layer1_variables)
+            c3 = bottleneck_layer (c2, filters=128, blocks=4, strides=2,
+                                   name='block_layer2',
+                                   variables=layer2_variables)
+            c4 = bottleneck_layer (c3, filters=256, blocks=6, strides=2,
+                                   name='block_layer3',
+                                   variables=layer3_variables)
+            c5 = bottleneck_layer (c4, filters=512, blocks=3, strides=2,
+                                   name='block_layer4',
+                                   variables=layer4_variables)
+        image_feature_map = dict (zip (FEATURE_MAP_KEYS, (c2, c3, c4, c5)))
+
+        # FPN, RPN and the head all consume fp32 NHWC feature maps.
+        for key, feature_map in image_feature_map.items ():
+            feature_map = tf.cast (feature_map, tf.float32)
+            if data_format == 'channels_first':
+                feature_map = tf.transpose (feature_map, [0, 2, 3, 1])
+            image_feature_map[key] = feature_map
+
+        return image_feature_map
@@ -0,0 +1,65 @@
+# -*- coding:utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import sys
+sys.path.append('../')
+import os
+import tensorflow as tf
+import numpy as np
+from libs.networks import resnet
+from libs.networks.network_factory import get_network_byname
+from data.read_tfrecord import predict_input_fn
+from config import TCTConfig
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+
+def calibrate(net_config):
+    """
+    Runs the trained backbone over BACKBONE_QUANT_CALIBRATION_STEPS images of the
+    eval set and saves the min and max every int8 quantization point sees to
+    BACKBONE_QUANT_RANGES, which BACKBONE_QUANTIZE then reads.
+    """
+    features = predict_input_fn(net_config).make_one_shot_iterator().get_next()
+    image_batch = features["image"] - tf.convert_to_tensor(net_config.PIXEL_MEANS, dtype=tf.float32)
+    # a quantizer without ranges only records them
+    quantizer = resnet.Int8Quantizer()
+    get_network_byname(inputs=image_batch,
+                       config=net_config,
+                       is_training=False,
+                       reuse=tf.AUTO_REUSE,
+                       mode=tf.estimator.ModeKeys.PREDICT,
+                       quantizer=quantizer)
+    saver = tf.train.Saver(tf.global_variables(net_config.BACKBONE_NET + "/"))
+
+    session_config = tf.ConfigProto()
+    session_config.gpu_options.allow_growth = True
+    session_config.allow_soft_placement = True
+    ranges = {}
+    num_images = 0
+    with tf.Session(config=session_config) as sess:
+        saver.restore(sess, tf.train.latest_checkpoint(os.path.join(net_config.MODLE_DIR,
+                                                                    net_config.NET_NAME)))
+        for _ in range(net_config.BACKBONE_QUANT_CALIBRATION_STEPS):
+            try:
+                observed = sess.run(quantizer.observers)
+            except tf.errors.OutOfRangeError:
+                break
+            num_images += 1
+            for key, (min_value, max_value) in observed.items():
+                if key in ranges:
+                    min_value = np.minimum(ranges[key][0], min_value)
+                    max_value = np.maximum(ranges[key][1], max_value)
+                ranges[key] = (min_value, max_value)
+        tf.logging.info("calibrated %d quantization points on %d images", len(ranges), num_images)
+
+    np.savez(net_config.BACKBONE_QUANT_RANGES,
+             **{key: np.stack(value) for key, value in ranges.items()})
+
+
+if __name__ == "__main__":
+    os.environ["CUDA_VISIBLE_DEVICES"] = "0"
+    calibrate(TCTConfig())
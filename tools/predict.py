@@ -27,7 +27,8 @@ def model_fn(features,
     _, share_net = get_network_byname(inputs=image_batch,
                                       config=net_config,
                                       is_training=IS_TRAINING,
-                                      reuse=tf.AUTO_REUSE)
+                                      reuse=tf.AUTO_REUSE,
+                                      mode=mode)
     # ***********************************************************************************************
     # *                                            FPN                                              *
     # ***********************************************************************************************
@@ -10,6 +10,7 @@ import os
 import tensorflow as tf
 import numpy as np
 import tensorflow.contrib.slim as slim
+from tensorflow.core.protobuf import rewriter_config_pb2
 from libs.networks.network_factory import get_network_byname
 from libs import build_rpn, build_head, build_fpn
 from libs.box_utils.show_box_in_tensor import draw_boxes_with_scores, draw_boxes_with_categories_and_scores
@@ -44,7 +45,8 @@ def model_fn(features,
     _, share_net = get_network_byname(inputs=image_batch,
                                       config=net_config,
                                       is_training=False,
-                                      reuse=tf.AUTO_REUSE)
+                                      reuse=tf.AUTO_REUSE,
+                                      mode=mode)
     # ***********************************************************************************************
     # *                                      FPN                                          *
     # ***********************************************************************************************
@@ -108,17 +110,29 @@ def model_fn(features,
     print_tensors(head_total_loss,"head_loss")
     print_tensors(rpn_total_loss,"rpn_loss")
     global_step = tf.train.get_or_create_global_step()
-    tf.train.init_from_checkpoint(net_config.CHECKPOINT_DIR,
-                                  {net_config.BACKBONE_NET + "/": net_config.BACKBONE_NET + "/"})
+    if net_config.BACKBONE_RESIDUAL_BIAS or net_config.BACKBONE_CONV_STEM:
+        # the residual biases and the conv stem are not in the pretrained checkpoint
+        backbone_variables = {v.op.name: v for v in tf.global_variables(net_config.BACKBONE_NET + "/")
+                              if not v.op.name.endswith("/bias") and "/conv_stem/" not in v.op.name}
+        tf.train.init_from_checkpoint(net_config.CHECKPOINT_DIR, backbone_variables)
+    else:
+        tf.train.init_from_checkpoint(net_config.CHECKPOINT_DIR,
+                                      {net_config.BACKBONE_NET + "/": net_config.BACKBONE_NET + "/"})
     with tf.name_scope("optimizer"):
         lr = tf.train.piecewise_constant(global_step,
                                          boundaries=[np.int64(net_config.BOUNDARY[0])],
                                          values=[net_config.LEARNING_RATE, net_config.LEARNING_RATE / 10])
         optimizer = tf.train.MomentumOptimizer(lr, momentum=net_config.MOMENTUM)
-        optimizer = tf.contrib.estimator.TowerOptimizer(optimizer)
+        if not net_config.MIRRORED_STRATEGY:
+            optimizer = tf.contrib.estimator.TowerOptimizer(optimizer)
         update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
         with tf.control_dependencies([tf.group(*update_ops)]):
-            grads = optimizer.compute_gradients(total_loss)
+            if net_config.LOSS_SCALE != 1:
+                scaled_grads = optimizer.compute_gradients(total_loss * net_config.LOSS_SCALE)
+                grads = [(grad / net_config.LOSS_SCALE if grad is not None else None, var)
+                         for grad, var in scaled_grads]
+            else:
+                grads = optimizer.compute_gradients(total_loss)
             # clip gradients
             grads = tf.contrib.training.clip_gradient_norms(grads, net_config.CLIP_GRADIENT_NORM)
             train_op = optimizer.apply_gradients(grads, global_step)
@@ -167,20 +181,41 @@ def model_fn(features,
                                           eval_metric_ops=metric_ap_dict)
 
 
+def build_estimator(net_config, session_config):
+    """
+    The training Estimator, with the multi-gpu setup MIRRORED_STRATEGY selects:
+    model_fn and train_input_fn only work with the matching one.
+    """
+    if net_config.MIRRORED_STRATEGY:
+        # mirrored variables on every GPU, gradients are all-reduced across them
+        distribution = tf.contrib.distribute.MirroredStrategy(devices=net_config.GPU_GROUPS)
+        estimator_model_fn = model_fn
+    else:
+        distribution = None
+        estimator_model_fn = tf.contrib.estimator.replicate_model_fn(model_fn,
+                                                                     devices=net_config.GPU_GROUPS)
+    estimator_config = tf.estimator.RunConfig(model_dir=os.path.join(net_config.MODLE_DIR, net_config.NET_NAME),
+                                              log_step_count_steps=200,
+                                              save_summary_steps=net_config.SAVE_EVERY_N_STEP,
+                                             save_checkpoints_steps=net_config.SAVE_EVERY_N_STEP,
+                                              session_config=session_config,
+                                              train_distribute=distribution)
+    return tf.estimator.Estimator(estimator_model_fn,
+                                  params={"net_config": net_config}, 
+                                  config=estimator_config)
+
+
 if __name__ == "__main__":
     os.environ["CUDA_VISIBLE_DEVICES"] = "0"
     net_config = TCTConfig()
+    if net_config.FP32_TENSOR_OP_MATH:
+        os.environ["TF_ENABLE_CUBLAS_TENSOR_OP_MATH_FP32"] = "1"
+        os.environ["TF_ENABLE_CUDNN_TENSOR_OP_MATH_FP32"] = "1"
     session_config = tf.ConfigProto()
     session_config.gpu_options.allow_growth = True
     session_config.allow_soft_placement = True
-    estimator_config = tf.estimator.RunConfig(model_dir=os.path.join(net_config.MODLE_DIR, net_config.NET_NAME),
-                                              log_step_count_steps=200,
-                                              save_summary_steps=net_config.SAVE_EVERY_N_STEP,
-                                             save_checkpoints_steps=net_config.SAVE_EVERY_N_STEP,
-                                              session_config=session_config)
-    my_estimator = tf.estimator.Estimator(tf.contrib.estimator.replicate_model_fn(model_fn,
-                                          devices=net_config.GPU_GROUPS),
-                                          params={"net_config": net_config}, 
-                                          config=estimator_config)
+    # let grappler fuse FusedBatchNorm+Relu and Conv2D+BiasAdd(+Relu) in the backbone
+    session_config.graph_options.rewrite_options.remapping = rewriter_config_pb2.RewriterConfig.ON
+    my_estimator = build_estimator(net_config, session_config)
     my_estimator.train(input_fn=lambda: train_input_fn(net_config))
 